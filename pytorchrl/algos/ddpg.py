@@ -1,23 +1,38 @@
 import copy
+import queue
+import threading
 
 import numpy as np
-import pyprind
 
 from rllab.algos.base import RLAlgorithm
-from rllab.algos.ddpg import SimpleReplayPool
 from rllab.misc import special
 from rllab.misc import ext
 import rllab.misc.logger as logger
 
 import torch
-from torch.autograd import Variable
 import torch.nn as nn
 from torch import optim
 
-from pytorchrl.misc.tensor_utils import running_average_tensor_list
+from pytorchrl.envs.vec_env import VecEnv
+from pytorchrl.replay import SimpleReplayPool
 from pytorchrl.sampler import parallel_sampler
 from pytorchrl.sampler.utils import rollout
 
+
+@torch.jit.script
+def _bellman_target(rewards, terminals, discount: float, next_qvals):
+    """
+    Elementwise Bellman target
+    r + (1 - terminal) * discount * Q'(s', a').
+
+    All inputs are (N, 1) columns, as handed out by the replay pool.
+    Scripted so the complement, scale and add run as one compiled
+    graph per update instead of several Python-dispatched kernel
+    launches.
+    """
+    return rewards + (1.0 - terminals) * discount * next_qvals
+
+
 class DDPG(RLAlgorithm):
     def __init__(
         self,
@@ -25,6 +40,8 @@ class DDPG(RLAlgorithm):
         policy,
         qf,
         es,
+        policy_factory=None,
+        qf_factory=None,
         batch_size=32,
         n_epochs=200,
         epoch_length=1000,
@@ -42,6 +59,9 @@ class DDPG(RLAlgorithm):
         soft_target=True,
         soft_target_tau=0.001,
         n_updates_per_sample=1,
+        n_envs=1,
+        async_sampling=False,
+        use_autocast=False,
         scale_reward=1.0,
         store_path=False,
         include_horizon_terminal_transitions=False,
@@ -51,8 +71,8 @@ class DDPG(RLAlgorithm):
         """
         """
         self.env = env
-        self.observation_dim = np.prod(env.observation_space.shape)
-        self.action_dim = np.prod(env.action_space.shape)
+        self.observation_dim = int(np.prod(env.observation_space.shape))
+        self.action_dim = int(np.prod(env.action_space.shape))
         self.policy = policy
         self.qf = qf
         self.es = es
@@ -68,14 +88,64 @@ class DDPG(RLAlgorithm):
         self.eval_samples = eval_samples
         self.soft_target_tau = soft_target_tau
         self.n_updates_per_sample = n_updates_per_sample
+        self.n_envs = n_envs
+        self.async_sampling = async_sampling
+        # Guards the exploration policy parameters when sampling runs
+        # in a background thread
+        self._sample_policy_lock = threading.Lock()
         self.include_horizon_terminal_transitions = include_horizon_terminal_transitions
 
         self.plot = plot
         self.pause_for_plot = pause_for_plot
 
         # Target network
-        self.target_qf = copy.deepcopy(self.qf)
-        self.target_policy = copy.deepcopy(self.policy)
+        self.target_qf = self._make_target(self.qf, qf_factory)
+        self.target_policy = self._make_target(self.policy, policy_factory)
+
+        # Run the networks on GPU when one is available. The parameters
+        # stay on self.device for the whole training run, only the
+        # replay batches are transferred on each update.
+        self.device = torch.device(
+            'cuda' if torch.cuda.is_available() else 'cpu')
+        # The update step is memory bound for MLPs of this size; bf16
+        # autocast halves the activation bandwidth while parameters and
+        # optimizer state stay in float32, so no grad scaling is needed
+        self.use_autocast = use_autocast and self.device.type == 'cuda'
+        self.qf.to(self.device)
+        self.policy.to(self.device)
+        self.target_qf.to(self.device)
+        self.target_policy.to(self.device)
+
+        # The target networks are only written through the soft update,
+        # autograd never needs gradients for their parameters
+        for param in self.target_qf.parameters():
+            param.requires_grad_(False)
+        for param in self.target_policy.parameters():
+            param.requires_grad_(False)
+
+        # The parameter lists are walked on every update (soft target
+        # update, freezing qf for the policy step); cache them once
+        # instead of re-traversing the module tree each time
+        self._qf_params = list(self.qf.parameters())
+        self._policy_params = list(self.policy.parameters())
+        self._target_qf_params = list(self.target_qf.parameters())
+        self._target_policy_params = list(self.target_policy.parameters())
+
+        # Staging buffers for the replay minibatches. They are allocated
+        # once and reused on every update, which avoids allocating fresh
+        # tensors per minibatch; pinned memory lets the host to device
+        # copy run asynchronously when training on GPU.
+        pin_memory = self.device.type == 'cuda'
+        self._obs_buf = torch.empty(
+            batch_size, self.observation_dim, pin_memory=pin_memory)
+        self._next_obs_buf = torch.empty(
+            batch_size, self.observation_dim, pin_memory=pin_memory)
+        self._actions_buf = torch.empty(
+            batch_size, self.action_dim, pin_memory=pin_memory)
+        self._rewards_buf = torch.empty(
+            batch_size, 1, pin_memory=pin_memory)
+        self._terminals_buf = torch.empty(
+            batch_size, 1, pin_memory=pin_memory)
 
         # Define optimizer
         self.qf_optimizer = qf_update_method(self.qf.parameters(),
@@ -94,8 +164,37 @@ class DDPG(RLAlgorithm):
         self.store_path = store_path
         self.scale_reward = scale_reward
 
+    @staticmethod
+    def _make_target(module, factory=None):
+        """
+        Build a target network holding the same weights as module.
+
+        Parameters
+        ----------
+        module (nn.Module): network to mirror.
+        factory (callable): zero-argument callable returning a freshly
+            constructed module of the same architecture. When given,
+            the target is built through it and the weights are copied
+            over with load_state_dict, which avoids deepcopy's
+            traversal of arbitrary Python state; without a factory the
+            module is deepcopied.
+
+        Returns
+        -------
+        target (nn.Module): target network with copied weights.
+        """
+        if factory is None:
+            return copy.deepcopy(module)
+        target = factory()
+        target.load_state_dict(module.state_dict())
+        return target
+
     def start_worker(self):
-        parallel_sampler.populate_task(self.env, self.policy)
+        # The sampler workers run on CPU (they hide the GPU through
+        # CUDA_VISIBLE_DEVICES and could not deserialize a CUDA
+        # module), so hand them a CPU copy of the policy
+        parallel_sampler.populate_task(
+            self.env, copy.deepcopy(self.policy).cpu())
 
     def train(self):
         pool = SimpleReplayPool(
@@ -107,55 +206,54 @@ class DDPG(RLAlgorithm):
         self.start_worker()
 
         itr = 0
-        path_length = 0
-        path_return = 0
-        terminal = False
-        # Seed the environment
-        self.env.seed(np.random.randint(2**32-1))
-        observation = self.env.reset()
+        vec_env = VecEnv(self.env, self.n_envs)
+        # Each environment carries its own exploration noise process
+        ess = [self.es] + [
+            copy.deepcopy(self.es) for _ in range(self.n_envs - 1)]
+        # Seed the environments
+        vec_env.seed(np.random.randint(2**32-1, size=self.n_envs))
+        # Mutable sampling state, shared between the synchronous loop
+        # and the background sampler. The first sample of every
+        # environment starts an episode.
+        state = dict(
+            observations=vec_env.reset(),
+            path_lengths=np.zeros(self.n_envs, dtype=int),
+            path_returns=np.zeros(self.n_envs),
+            initials=np.ones(self.n_envs, dtype='uint8'),
+        )
 
-        sample_policy = copy.deepcopy(self.policy)
+        # The exploration policy acts on small observation batches, keep
+        # it on CPU to avoid a device round trip per environment step.
+        sample_policy = copy.deepcopy(self.policy).cpu()
 
         for epoch in range(self.n_epoch):
             logger.push_prefix('epoch #%d | ' % epoch)
             logger.log("Training started")
-            for epoch_itr in pyprind.prog_bar(range(self.epoch_length)):
-                # Execute policy
-                if terminal:  # or path_length > self.max_path_length:
-                    # Note that if the last time step ends an episode, the very
-                    # last state and observation will be ignored and not added
-                    # to the replay pool
-                    observation = self.env.reset()
-                    self.es.reset()
-                    sample_policy.reset()
-                    self.es_path_returns.append(path_return)
-                    path_length = 0
-                    path_return = 0
-
-                action = self.es.get_action(itr, observation, policy=sample_policy)
-
-                next_observation, reward, terminal, _ = self.env.step(action)
-                path_length += 1
-                path_return += reward
-
-                if not terminal and path_length >= self.max_path_length:
-                    terminal = True
-                    # only include the terminal transition in this case if the flag was set
-                    if self.include_horizon_terminal_transitions:
-                        pool.add_sample(observation, action, reward * self.scale_reward, terminal)
-                else:
-                    pool.add_sample(observation, action, reward * self.scale_reward, terminal)
-
-                observation = next_observation
-
-                if pool.size >= self.min_pool_size:
-                    for update_itr in range(self.n_updates_per_sample):
-                        # Train policy
-                        batch = pool.random_batch(self.batch_size)
-                        self.do_training(itr, batch)
-                    sample_policy.set_param_values(self.policy.get_param_values())
-
-                itr += 1
+            if self.async_sampling:
+                itr = self._run_epoch_async(
+                    itr, pool, vec_env, ess, sample_policy, state)
+            else:
+                # pyprind redrew a progress bar on every iteration of
+                # this hot loop; an occasional log line is enough
+                # feedback
+                for epoch_itr in range(0, self.epoch_length, self.n_envs):
+                    if epoch_itr > 0 and epoch_itr % 1000 < self.n_envs:
+                        logger.log("step %d/%d" % (
+                            epoch_itr, self.epoch_length))
+                    transitions = self._step_envs(
+                        vec_env, ess, sample_policy, state)
+                    for transition in transitions:
+                        pool.add_sample(*transition)
+
+                    if pool.size >= self.min_pool_size:
+                        for update_itr in range(
+                                self.n_updates_per_sample * self.n_envs):
+                            # Train policy
+                            batch = pool.random_batch(self.batch_size)
+                            self.do_training(itr, batch)
+                        self._sync_sample_policy(sample_policy)
+
+                    itr += self.n_envs
 
             logger.log("Training finished")
             if pool.size >= self.min_pool_size:
@@ -172,7 +270,146 @@ class DDPG(RLAlgorithm):
                 if self.pause_for_plot:
                     input("Plotting evaluation run: Press Enter to "
                               "continue...")
-        self.env.terminate()
+        vec_env.terminate()
+
+    def _sync_sample_policy(self, sample_policy):
+        """
+        Refresh the CPU exploration policy from the live policy.
+
+        The copies are done per parameter, so no flat tensor is built
+        the way get_param_values/set_param_values would; copy_ handles
+        the device-to-host transfer itself.
+
+        Parameters
+        ----------
+        sample_policy (Policy): CPU copy of the policy used for acting.
+        """
+        with torch.no_grad():
+            for sample_param, param in zip(
+                    sample_policy.parameters(), self._policy_params):
+                sample_param.data.copy_(param.data)
+
+    def _step_envs(self, vec_env, ess, sample_policy, state):
+        """
+        Advance every environment by one step under the exploration
+        policy. One batched forward amortizes the policy over all
+        environments, then each environment adds its own exploration
+        noise.
+
+        Parameters
+        ----------
+        vec_env (VecEnv): the vectorized environments.
+        ess (list): exploration strategy per environment.
+        sample_policy (Policy): CPU copy of the policy used for acting.
+        state (dict): mutable sampling state with keys observations,
+            path_lengths, path_returns and initials; updated in place.
+
+        Returns
+        -------
+        transitions (list): one (observation, action, reward, terminal,
+            initial) tuple per transition destined for the replay pool.
+        """
+        observations = state['observations']
+        policy_actions, _ = sample_policy.get_action(observations)
+        actions = np.stack([
+            np.clip(policy_action + es.evolve_state(),
+                self.env.action_space.low,
+                self.env.action_space.high)
+            for policy_action, es in zip(policy_actions, ess)])
+
+        next_observations, rewards, terminals, _ = vec_env.step(actions)
+        state['path_lengths'] += 1
+        state['path_returns'] += rewards
+
+        transitions = []
+        for index in range(self.n_envs):
+            terminal = terminals[index]
+            reward = rewards[index]
+            if not terminal and \
+                    state['path_lengths'][index] >= self.max_path_length:
+                terminal = True
+                # only include the terminal transition in this case if the flag was set
+                if self.include_horizon_terminal_transitions:
+                    transitions.append((observations[index],
+                        actions[index], reward * self.scale_reward,
+                        terminal, state['initials'][index]))
+            else:
+                transitions.append((observations[index],
+                    actions[index], reward * self.scale_reward,
+                    terminal, state['initials'][index]))
+            state['initials'][index] = 1 if terminal else 0
+
+            if terminal:
+                # Note that if the last time step ends an episode, the
+                # very last state and observation will be ignored and
+                # not added to the replay pool
+                next_observations[index] = vec_env.reset_env(index)
+                ess[index].reset()
+                sample_policy.reset()
+                self.es_path_returns.append(state['path_returns'][index])
+                state['path_lengths'][index] = 0
+                state['path_returns'][index] = 0
+
+        state['observations'] = next_observations
+        return transitions
+
+    def _run_epoch_async(self, itr, pool, vec_env, ess, sample_policy,
+                         state):
+        """
+        Run one epoch with sampling and training overlapped.
+
+        A background thread steps the environments and enqueues the
+        transitions of each vector step, while this thread drains them
+        into the replay pool and runs the updates. The exploration
+        policy is refreshed under a lock so the sampler never acts on
+        half-written parameters.
+
+        Parameters
+        ----------
+        itr (int): iteration counter at the start of the epoch.
+        pool (SimpleReplayPool): the replay pool.
+        vec_env (VecEnv): the vectorized environments.
+        ess (list): exploration strategy per environment.
+        sample_policy (Policy): CPU copy of the policy used for acting.
+        state (dict): mutable sampling state, see _step_envs.
+
+        Returns
+        -------
+        itr (int): iteration counter after the epoch.
+        """
+        transition_queue = queue.Queue(maxsize=64)
+
+        def produce():
+            for _ in range(0, self.epoch_length, self.n_envs):
+                with self._sample_policy_lock:
+                    transitions = self._step_envs(
+                        vec_env, ess, sample_policy, state)
+                transition_queue.put(transitions)
+            transition_queue.put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        while True:
+            transitions = transition_queue.get()
+            if transitions is None:
+                break
+            for transition in transitions:
+                pool.add_sample(*transition)
+
+            if pool.size >= self.min_pool_size:
+                for update_itr in range(
+                        self.n_updates_per_sample * self.n_envs):
+                    # Train policy
+                    batch = pool.random_batch(self.batch_size)
+                    self.do_training(itr, batch)
+                with self._sample_policy_lock:
+                    self._sync_sample_policy(sample_policy)
+
+            itr += self.n_envs
+
+        producer.join()
+        return itr
 
     def do_training(self, itr, batch):
         # Update Q Function
@@ -182,83 +419,119 @@ class DDPG(RLAlgorithm):
             "terminals"
         )
 
-        next_actions, _ = self.target_policy.get_action(next_obs)
-        next_qvals = self.target_qf.get_qval(next_obs, next_actions)
-
-        rewards = rewards.reshape(-1, 1)
-        terminals_mask = (1.0 - terminals).reshape(-1, 1)
-        ys = rewards + terminals_mask * self.discount * next_qvals
-
-        qf_loss = self.train_qf(ys, obs, actions)
-        policy_surr = self.train_policy(obs)
-
-        self.target_policy.set_param_values(
-            self.target_policy.get_param_values() * (1 - self.soft_target_tau) +
-            self.policy.get_param_values() * self.soft_target_tau)
-
-        self.target_qf.set_param_values(
-            self.target_qf.get_param_values() * (1 - self.soft_target_tau) +
-            self.qf.get_param_values() * self.soft_target_tau)
+        obs = self._stage(self._obs_buf, obs)
+        actions = self._stage(self._actions_buf, actions)
+        next_obs = self._stage(self._next_obs_buf, next_obs)
+        rewards = self._stage(self._rewards_buf, rewards)
+        terminals = self._stage(self._terminals_buf, terminals)
+
+        # The target values are never backpropagated through, skip
+        # building an autograd graph for the target forward passes
+        with torch.no_grad():
+            next_actions = self.target_policy(next_obs)
+            next_qvals = self.target_qf(next_obs, next_actions)
+
+            # Bellman target, computed on self.device so the values
+            # never bounce back to numpy between the target forward
+            # and the fit
+            ys = _bellman_target(
+                rewards, terminals, self.discount, next_qvals)
+
+        qf_loss, policy_surr = self.train_qf_and_policy(ys, obs, actions)
+
+        # Soft update of the target networks, done in place so no new
+        # parameter tensors are allocated per step
+        tau = self.soft_target_tau
+        with torch.no_grad():
+            for target_param, param in zip(
+                    self._target_policy_params, self._policy_params):
+                target_param.data.mul_(1 - tau).add_(param.data, alpha=tau)
+            for target_param, param in zip(
+                    self._target_qf_params, self._qf_params):
+                target_param.data.mul_(1 - tau).add_(param.data, alpha=tau)
 
         self.qf_loss_averages.append(qf_loss)
         self.policy_surr_averages.append(policy_surr)
 
+    def _stage(self, buffer, array):
+        """
+        Copy a numpy array drawn from the replay pool into a
+        preallocated staging buffer and transfer it to self.device.
+
+        Parameters
+        ----------
+        buffer (torch.Tensor): preallocated float32 staging tensor,
+            pinned when training on GPU.
+        array (numpy.ndarray): array to transfer, must have the same
+            shape as buffer.
+
+        Returns
+        -------
+        tensor (torch.Tensor): float32 tensor on self.device.
+        """
+        # as_tensor is zero-copy when the array is already contiguous
+        # float32, so the dtype conversion happens at most once
+        buffer.copy_(torch.as_tensor(array))
+        return buffer.to(self.device, non_blocking=True)
 
-    def train_qf(self, expected_qval, obs_val, actions_val):
+    def train_qf_and_policy(self, expected_q, obs, actions):
         """
         Given the mini-batch, fit the Q-value with L2 norm (defined
-        in optimizer).
+        in optimizer) and do gradient ascent on the policy in one
+        combined step over the same minibatch.
 
         Parameters
         ----------
-        expected_qval (numpy.ndarray): expected q values in numpy array
-            form.
-        obs_val (numpy.ndarray): states draw from mini-batch, should have
-            the same amount of rows as expected_qval.
-        actions_val (numpy.ndarray): actions draw from mini-batch, should
-            have the same amount of rows as expected_qval.
+        expected_q (torch.Tensor): expected q values, on self.device.
+        obs (torch.Tensor): states draw from mini-batch, should have
+            the same amount of rows as expected_q.
+        actions (torch.Tensor): actions draw from mini-batch, should
+            have the same amount of rows as expected_q.
+
+        Returns
+        -------
+        qf_loss (float): value of the fitted Q loss.
+        policy_surr (float): value of the policy surrogate.
         """
-        # Create Variable for input and output, we do not need gradient
-        # of loss with respect to these variables
-        obs = Variable(torch.from_numpy(obs_val)).type(
-            torch.FloatTensor)
-        actions = Variable(torch.from_numpy(actions_val)).type(
-            torch.FloatTensor)
-        expected_q = Variable(torch.from_numpy(expected_qval)).type(
-            torch.FloatTensor)
-
-        q_vals = self.qf(obs, actions)
-
-        # Define loss function
-        loss_fn = nn.MSELoss()
-        loss = loss_fn(q_vals, expected_q)
-
-        # Backpropagation and gradient descent
+        with torch.autocast(self.device.type, dtype=torch.bfloat16,
+                enabled=self.use_autocast):
+            q_vals = self.qf(obs, actions)
+            # Do gradient descent on the policy, so need to add minus
+            # in front
+            policy_surr = -self.qf(obs, self.policy(obs)).mean()
+
+            # Define loss function
+            loss_fn = nn.MSELoss()
+            qf_loss = loss_fn(q_vals, expected_q)
+
+        # The policy gradient is taken with respect to the policy
+        # parameters only, so no Q-function gradients are accumulated
+        # just to be thrown away. It must be computed before the qf
+        # optimizer step: the surrogate's graph saved the Q-function
+        # weights, and stepping mutates them in place, which would make
+        # this backward pass fail (and it keeps the gradient evaluated
+        # against the pre-step Q function).
+        policy_grads = torch.autograd.grad(
+            policy_surr, self._policy_params)
+
+        # Backpropagation and gradient descent for the Q function
         self.qf_optimizer.zero_grad()
-        loss.backward()
+        qf_loss.backward()
         self.qf_optimizer.step()
 
-        return loss.data.numpy()
-
-    def train_policy(self, obs_val):
-        """
-        Given the mini-batch, do gradient ascent on policy
-        """
-        obs = Variable(torch.from_numpy(obs_val)).type(torch.FloatTensor)
-
-        # Do gradient descent, so need to add minus in front
-        average_q = -self.qf(obs, self.policy(obs)).mean()
-
         self.policy_optimizer.zero_grad()
-        average_q.backward()
+        for param, grad in zip(self._policy_params, policy_grads):
+            param.grad = grad
         self.policy_optimizer.step()
 
-        return average_q.data.numpy()
+        # item() also handles the bf16 surrogate under autocast, which
+        # numpy has no dtype for
+        return qf_loss.item(), policy_surr.item()
 
     def evaluate(self, epoch, pool):
         logger.log("Collecting samples for evaluation")
         paths = parallel_sampler.sample_paths(
-            policy_params=self.policy.get_param_values(),
+            policy_params=self.policy.get_param_values().cpu(),
             max_samples=self.eval_samples,
             max_path_length=self.max_path_length,
         )
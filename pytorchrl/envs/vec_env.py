@@ -0,0 +1,101 @@
+import pickle
+
+import numpy as np
+
+
+class VecEnv(object):
+    """
+    Step several copies of an environment in lockstep.
+
+    The caller batches one policy forward over the stacked observations
+    and hands one row of actions back per environment. The environments
+    are stepped serially in process, which is enough to amortize the
+    policy forward over n_envs observations.
+
+    Observations come back flattened and as float32, so the sampling
+    loop does no per-step reshape or dtype conversion of its own.
+    """
+    def __init__(self, env, n_envs):
+        """
+        Create the environment copies.
+
+        Parameters
+        ----------
+        env (Env): environment to replicate. The copies are created by
+            round tripping the environment through pickle, the same way
+            the parallel sampler ships environments to its workers.
+        n_envs (int): number of copies to step in lockstep.
+        """
+        self.envs = [env] + [
+            pickle.loads(pickle.dumps(env)) for _ in range(n_envs - 1)]
+        self.n_envs = n_envs
+
+    def _flatten(self, observation):
+        """
+        Flatten one observation to a float32 vector.
+        """
+        return np.asarray(observation, dtype=np.float32).reshape(-1)
+
+    def seed(self, seeds):
+        """
+        Seed every environment with its entry of seeds.
+        """
+        for env, seed in zip(self.envs, seeds):
+            env.seed(seed)
+
+    def reset(self):
+        """
+        Reset every environment.
+
+        Returns
+        -------
+        observations (numpy.ndarray): stacked observations, one row per
+            environment.
+        """
+        return np.stack([self._flatten(env.reset()) for env in self.envs])
+
+    def reset_env(self, index):
+        """
+        Reset a single environment.
+
+        Parameters
+        ----------
+        index (int): which environment to reset.
+
+        Returns
+        -------
+        observation (numpy.ndarray): observation of the reset
+            environment.
+        """
+        return self._flatten(self.envs[index].reset())
+
+    def step(self, actions):
+        """
+        Step every environment with its row of actions.
+
+        Parameters
+        ----------
+        actions (numpy.ndarray): one row of actions per environment.
+
+        Returns
+        -------
+        observations (numpy.ndarray): stacked next observations.
+        rewards (numpy.ndarray): reward per environment.
+        terminals (numpy.ndarray): terminal flag per environment.
+        infos (list): info dict per environment.
+        """
+        observations = []
+        rewards = np.zeros(self.n_envs)
+        terminals = np.zeros(self.n_envs, dtype='uint8')
+        infos = []
+        for index, (env, action) in enumerate(zip(self.envs, actions)):
+            observation, reward, terminal, info = env.step(action)
+            observations.append(self._flatten(observation))
+            rewards[index] = reward
+            terminals[index] = terminal
+            infos.append(info)
+        return np.stack(observations), rewards, terminals, infos
+
+    def terminate(self):
+        for env in self.envs:
+            env.terminate()
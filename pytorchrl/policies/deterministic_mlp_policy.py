@@ -1,5 +1,4 @@
 import torch
-from torch.autograd import Variable
 import torch.nn as nn
 
 from rllab.misc.overrides import overrides
@@ -80,13 +79,17 @@ class DeterministicMLPPolicy(Policy, Parameterized):
         action (numpy.ndarray): action for the observation.
         other_info (dict): Additional info for the action
         """
-        # Need to first convert observation into Variable
-        obs_variable = Variable(torch.from_numpy(observation),
-            volatile=True).type(torch.FloatTensor)
-
-        action = self.forward(obs_variable)
-
-        return action.data.numpy(), dict()
+        # Action selection never backpropagates, skip building the
+        # autograd graph for the forward pass
+        with torch.no_grad():
+            # Build the input on whatever device the parameters live
+            # on, so the policy can also act while it sits on GPU
+            device = next(self.parameters()).device
+            obs_tensor = torch.as_tensor(
+                observation, dtype=torch.float32, device=device)
+            action = self.forward(obs_tensor)
+
+        return action.cpu().numpy(), dict()
 
     @overrides
     def get_internal_params(self):
@@ -18,17 +18,20 @@ class SimpleReplayPool(object):
         self._replacement_policy = replacement_policy
         self._replacement_prob = replacement_prob
         self._max_skip_episode = max_skip_episode
-        self._observations = np.zeros((max_pool_size, observation_dim),)
+        self._observations = self._allocate((max_pool_size, observation_dim))
         if env is not None and env.action_space.is_discrete:
-            self._actions = np.zeros((max_pool_size,),dtype=np.int64)
+            self._actions = self._allocate((max_pool_size,), dtype=np.int64)
             self._n = env.action_space.n
             self._is_action_discrete = True
         else:
-            self._actions = np.zeros((max_pool_size, action_dim),)
+            self._actions = self._allocate((max_pool_size, action_dim))
             self._is_action_discrete = False
-        self._rewards = np.zeros(max_pool_size)
-        self._terminals = np.zeros(max_pool_size, dtype='uint8')
-        self._initials = np.zeros(max_pool_size, dtype='uint8')
+        # Rewards and terminals are stored as (N, 1) columns so
+        # random_batch hands out batches already shaped for the Bellman
+        # target, with no per-step reshape on the consumer side
+        self._rewards = self._allocate((max_pool_size, 1))
+        self._terminals = self._allocate((max_pool_size, 1), dtype='uint8')
+        self._initials = self._allocate((max_pool_size,), dtype='uint8')
         self._observations.fill(0) # pre-allocate
         self._actions.fill(0) # pre-allocate
         self._terminals.fill(0) # pre-allocate
@@ -42,6 +45,26 @@ class SimpleReplayPool(object):
         # Size of the replay buffer
         self._size = 0
 
+    def _allocate(self, shape, dtype=np.float32):
+        """
+        Allocate one storage array of the pool. Subclasses may override
+        this to change where the storage lives.
+
+        Float arrays are stored as float32: it halves the memory and
+        bandwidth of the replay reads and matches the float32 networks,
+        so no dtype cast is left on the batch path.
+
+        Parameters
+        ----------
+        shape (tuple): shape of the array.
+        dtype: numpy dtype of the array.
+
+        Returns
+        -------
+        array (np.ndarray): zero-filled array of the requested shape.
+        """
+        return np.zeros(shape, dtype=dtype)
+
     def add_sample(self, observation, action, reward, terminal, initial):
         """
         Add a sample to current replay buffer.
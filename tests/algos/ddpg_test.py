@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+
+from pytorchrl.algos.ddpg import DDPG
+from pytorchrl.exploration_strategies.ou_strategy import OUStrategy
+from pytorchrl.policies.deterministic_mlp_policy import DeterministicMLPPolicy
+from pytorchrl.q_functions.continuous_mlp_q_function import ContinuousMLPQFunction
+
+
+class DummySpace(object):
+    def __init__(self, shape):
+        self.shape = shape
+        self.low = -np.ones(shape)
+        self.high = np.ones(shape)
+
+
+class DummyEnv(object):
+    def __init__(self, observation_dim, action_dim):
+        self.observation_space = DummySpace((observation_dim,))
+        self.action_space = DummySpace((action_dim,))
+
+
+class TestDDPG(unittest.TestCase):
+
+    def test_do_training(self):
+        observation_dim = 3
+        action_dim = 2
+        batch_size = 8
+
+        env = DummyEnv(observation_dim, action_dim)
+        policy = DeterministicMLPPolicy(observation_dim, action_dim,
+            hidden_sizes=(4, 4))
+        qf = ContinuousMLPQFunction(observation_dim, action_dim,
+            hidden_sizes=(4, 4))
+        es = OUStrategy(env.action_space)
+        algo = DDPG(env, policy, qf, es, batch_size=batch_size)
+
+        batch = dict(
+            observations=np.random.randn(
+                batch_size, observation_dim).astype(np.float32),
+            actions=np.random.randn(
+                batch_size, action_dim).astype(np.float32),
+            rewards=np.random.randn(batch_size, 1).astype(np.float32),
+            next_observations=np.random.randn(
+                batch_size, observation_dim).astype(np.float32),
+            terminals=np.zeros((batch_size, 1), dtype='uint8'),
+        )
+        algo.do_training(0, batch)
+
+        assert len(algo.qf_loss_averages) == 1
+        assert np.isfinite(algo.qf_loss_averages[0])
+        assert np.isfinite(algo.policy_surr_averages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()